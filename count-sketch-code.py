@@ -29,9 +29,10 @@
 # through Spark's RDD methods.
 # Before any transformation, the batch is filtered to exclude the items outside the 
 # input's specified interval [left,right].
-# On a batch per time, the Count Sketch algorithm is performed; specifically, the
-# function "count_sketch()" extracts the j-th update of the sketch from the RDD
-# through a MapReduce approach. The hash functions "h_hash()" and "g_hash()" are used to
+# On a batch per time, the Count Sketch algorithm is performed in a single MapReduce
+# pass over the RDD: each partition parses and filters its items, counts them, and
+# builds its local sketch through the function "count_sketch()"; the results of the
+# partitions are then summed. The hash functions "h_hash()" and "g_hash()" are used to
 # map the items' count into a lower dimensional space, specified by the input parameters
 # W and D, which values determine the performance/accuracy tradeoff.
 # The stream processing's stop is invoked after approximately 10M items have been read.
@@ -48,6 +49,9 @@
 from pyspark import SparkContext, SparkConf
 from pyspark.streaming import StreamingContext
 from pyspark import StorageLevel
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 import numpy as np
 import threading
 import sys
@@ -58,79 +62,138 @@ THRESHOLD = 10000000
 # -----------------------------------------
 #       HASH FUNCTIONS & COUNT SKETCH
 # -----------------------------------------
-# Hash function h: U -> {0, ..., W-1}
-def h_hash(x,a,b):
-    return ((a*int(x) + b) % p) % W
+# Both hash functions are multiply-shift hashes: the item is multiplied by an odd
+# 64-bit seed (modulo 2^64) and the highest bits of the product are kept.
+# They work element-wise on uint64 NumPy arrays of items and seeds
+
+# Hash function h: U -> {0, ..., W-1}: the highest 32 bits of the product are mapped
+# onto {0, ..., W-1} by a second multiply-shift, (h32 * W) >> 32, with no modulo
+def h_hash(x,seed):
+    h32 = (x*seed) >> np.uint64(32)
+    return (h32*np.uint64(W)) >> np.uint64(32)
 
 # Hash function g: U -> {-1, 1}
-def g_hash(x,a,b):
-    hash_value = ((a*int(x) + b) % p) % 2
+def g_hash(x,seed):
+    hash_value = ((x*seed) >> np.uint64(63)).astype(np.int64)
     return 2*hash_value - 1
 
-# Count sketch algorithm
-def count_sketch(f_batch):
-    global sketch
-    # i.e. repeat for all the hash functions h1, ..., hD and g1,...,gD
-    for j in np.arange(0, D):
-
-        # GOAL: extract the j-th update of the sketch from the RDD through a MapReduce approach
-        # 1) Map: from x to (hj(x),gj(x))
-        # 2) Reduce: from (hj(x),gj(x)) to (hj(x), sum gj(x))
-        # 3) collectAsMap: from (hj(x), sum gj(x)) to a dictionary {hj: sum gj(x)}
-
-        # Note that the count sketch algorithm requires D hash functions:
-        # U -> {0, ..., W-1} and D hash functions: U -> {-1, +1}. To achieve this
-        # result, we use only two hash functions, "h_hash" and "g_hash", which
-        # in total take 1,...,j,...,D*2 different "a" and "b" parameters
-
-        sketch_dict = f_batch.map(lambda x: (h_hash(x,a[j],b[j]), g_hash(x,a[j+D],b[j+D]))) \
-        .reduceByKey(lambda x, y: x + y) \
-        .collectAsMap()
-
-        # Update the sketch with the j-th update
-        for key in sketch_dict:
-            sketch[j,key] += sketch_dict[key]
+# Compiled kernel adding the items "x" (as uint64) to the D x W sketch "out"
+# The loop over the items is nested inside the loop over the rows: each row j only
+# writes its own contiguous W counters, and its seeds seeds[j], seeds[j+D] stay in
+# registers for the whole loop over the items. The uint64 products wrap around
+# exactly as in "h_hash" and "g_hash". The rows are not split across threads,
+# since Spark already runs one task per core
+# The updates of a row are scattered directly: sorting them by tile of the row
+# first (to keep the written counters in L1) costs an extra pass over the items
+# which, measured up to W = 2^24, is never repaid by the better write locality.
+# Generating a kernel specialized for the seeds and W (unrolled rows, constants
+# baked in) was not measurably faster either, up to W = 2^20
+@njit(cache=True)
+def sketch_kernel(x, seeds, w, D, out):
+    for j in range(D):
+        sj = seeds[j]
+        sj2 = seeds[j+D]
+        for i in range(x.size):
+            h = (((x[i]*sj) >> np.uint64(32))*w) >> np.uint64(32)
+            g = 2*np.int64((x[i]*sj2) >> np.uint64(63)) - 1
+            out[j,h] += g
+
+# Count sketch algorithm: local D x W sketch of the items "x" (an int64 array)
+def count_sketch(x):
+    # The D hash functions h1, ..., hD and g1, ..., gD are computed by the compiled
+    # kernel on the whole array instead of calling "h_hash" and "g_hash" per item.
+    # Note that the count sketch algorithm requires D hash functions:
+    # U -> {0, ..., W-1} and D hash functions: U -> {-1, +1}. To achieve this
+    # result, we use only two hash functions, "h_hash" and "g_hash", which
+    # in total take 1,...,j,...,D*2 different seeds
+    local = np.zeros((D, W), dtype=np.int32, order='C')
+    sketch_kernel(x.view(np.uint64), seeds_bc.value, np.uint64(W), D, local)
+    return local
 
 # ----------------------------------
 #       PROCESS_BATCH FUNCTION
 # ----------------------------------
-# Operations to perform after receiving an RDD 'batch' at time 'time'
-def process_batch(time, batch):
-    # We are working on the batch at time `time`.
-    global streamLength, histogram
+# All the work on a partition of the batch, in a single task: the whole batch is
+# processed in one Spark job
+def process_partition(it):
+    # 1) Converts the strings of the partition into one array of integers
+    # 2) Filter the elements which are not in the interval [left, right]
+    raw = np.array(list(it), dtype=np.int64)
+    x = raw[(raw >= left) & (raw <= right)]
+    # 3) Count the distinct items of the partition
+    values, counts = np.unique(x, return_counts=True)
+    items = Counter(dict(zip(values.tolist(), counts.tolist())))
+    # 4) Build the local sketch of the partition
+    return [(count_sketch(x), items, raw.size, x.size)]
+
+# Merge the results of two partitions: since the sketch is linear in the frequencies,
+# the sum of the local sketches is the sketch of the union of the partitions
+def merge_partitions(p1, p2):
+    return (p1[0] + p2[0], p1[1] + p2[1], p1[2] + p2[2], p1[3] + p2[3])
+
+# Merge a batch into the state of the stream. Since the sketch is linear, the
+# sketch of the stream is the sum of the sketches of its batches, in any order:
+# the lock only serializes the merges if batches are processed concurrently
+def merge_batch(batch_sketch, batch_items, batch_size, filtered_size):
+    global streamLength, histogram, sketch
 
     # a. "batch_size": size of the current batch
     # b. "streamLength[0]": size of the stream so far, i.e. sigma
     # c. "streamLength[1]": size of the stream so far after filtering, i.e. sigma_R
+    with state_lock:
+        streamLength[0] += batch_size
+        # The counters of the int32 sketch cannot exceed the stream length
+        assert streamLength[0] < 2**31, "ERROR - stream too long for the int32 sketch"
+        streamLength[1] += filtered_size
 
-    batch_size = batch.count()
-    # If we already have enough points (> THRESHOLD), skip this batch.
-    if streamLength[0]>=THRESHOLD:
-        return
-    streamLength[0] += batch_size
+        # Add the items of "batch_items" and their frequencies to "histogram"
+        # i.e., histogram contains the true absolute frequencies of the items seen so far
+        histogram.update(batch_items)
 
-    # 1) Converts the strings of the RDD into integers
-    # 2) Filter the elements in the batch which are not in the interval [left, right]
-    filtered_batch = batch.map(lambda x: int(x)).filter(lambda x: (x >= left) & (x <= right))
-    streamLength[1] += filtered_batch.count()
+        # Add the sketch of the batch to the sketch of the stream
+        sketch += batch_sketch
 
-    # Extract in a dictionary the distinct items from the batch
-    batch_items = filtered_batch.map(lambda s: (int(s), 1)).reduceByKey(lambda x, y: x + y).collectAsMap()
+        # Set the stopping condition
+        if streamLength[0] >= THRESHOLD:
+            stopping_condition.set()
 
-    # Store the items of "batch_items" and their frequencies into "hisogram"
-    # i.e., histogram contains the true absolute frequencies of the items seen so far
-    for key in batch_items:
-        if key not in histogram:
-            histogram[key] = batch_items[key]
-        else:
-            histogram[key] += batch_items[key]
+# Operations to perform after receiving an RDD 'batch' at time 'time'
+def process_batch(time, batch):
+    # We are working on the batch at time `time`.
+    global pending_merge
+
+    # If we already have enough points (> THRESHOLD), skip this batch.
+    if streamLength[0]>=THRESHOLD:
+        return
+    # A batch without partitions has nothing to add (and treeReduce would fail)
+    if batch.getNumPartitions() == 0:
+        return
 
-    # Run the count sketch algorithm
-    count_sketch(filtered_batch)
+    # GOAL: process the batch in a single MapReduce pass
+    # 1) mapPartitions: from the strings of a partition to its local sketch, its
+    #    distinct items, its size and its size after filtering
+    # 2) treeReduce: from the results of the partitions to the ones of the batch
+    # The driver only receives D x W counters and the distinct items per partition
+    batch_result = batch \
+    .mapPartitions(process_partition) \
+    .treeReduce(merge_partitions, depth=2)
+
+    # The merge of the previous batch ran on the merge thread while Spark processed
+    # this batch: wait for it (re-raising its errors, if any), then check again
+    # whether we already have enough points
+    if pending_merge is not None:
+        try:
+            pending_merge.result()
+        except Exception:
+            # A failed merge leaves the state half-updated: stop the stream (the main
+            # thread raises the error again before computing the outputs)
+            stopping_condition.set()
+            raise
+    if streamLength[0]>=THRESHOLD:
+        return
 
-    # Set the stopping condition
-    if streamLength[0] >= THRESHOLD:
-        stopping_condition.set()
+    # Merge this batch on the merge thread, overlapping with the next batch
+    pending_merge = merge_pool.submit(merge_batch, *batch_result)
 
 # ----------------
 #       MAIN
@@ -172,6 +235,12 @@ if __name__ == '__main__':
     # to deadlocks.
 
     stopping_condition = threading.Event()
+    # Lock protecting the state of the stream (streamLength, histogram, sketch)
+    state_lock = threading.Lock()
+    # Thread merging each batch into the state of the stream, while Spark processes
+    # the following batch, and the future of the last merge submitted to it
+    merge_pool = ThreadPoolExecutor(max_workers=1)
+    pending_merge = None
 
     # Input reading
     D = int(sys.argv[1]) # Sketch's number of rows
@@ -180,19 +249,22 @@ if __name__ == '__main__':
     right = int(sys.argv[4]) # right endpoint of the interval of interest
     K = int(sys.argv[5]) # number of top frequent items of interest
     portExp = int(sys.argv[6]) # port number
+    assert 0 < W < 2**32, "ERROR - W must be between 1 and 2^32-1"
 
     # Required data structures to maintain the state of the stream
     streamLength = [0,0] # Stream length (an array to be passed by reference)
-    histogram = {} # Hash Table for the distinct elements
-    approx_histogram = {} # Approximated Hash Table for the distinct elements
+    histogram = Counter() # Hash Table for the distinct elements
 
     # Initialise the ingredients of the hash functions
-    p = 8191
-    a = np.random.randint(low=1, high=p-1, size = D*2)
-    b = np.random.randint(low=0, high=p-1, size = D*2)
+    seeds = np.random.randint(low=1, high=2**63, size = D*2, dtype=np.uint64) | 1 # odd seeds
+    # Ship the seeds to the executors once, as a contiguous uint64 array, instead of
+    # pickling them with the closure of every task
+    seeds_bc = sc.broadcast(seeds)
 
-    # Initialise the sketch
-    sketch = np.zeros((D, W))
+    # Initialise the sketch: its counters are sums of +1/-1, bounded in absolute value
+    # by the stream length, so they are stored as int32, in row-major order so that
+    # each row is a contiguous block of memory
+    sketch = np.zeros((D, W), dtype=np.int32, order='C')
 
     # Create the Discretized Stream
     stream = ssc.socketTextStream("algo.dei.unipd.it", portExp, StorageLevel.MEMORY_AND_DISK)
@@ -215,22 +287,47 @@ if __name__ == '__main__':
     # to stop "gracefully", meaning that any outstanding work
     # will be done.
     ssc.stop(False, True)
+    # Wait for the merge of the last batch, and raise its error (if any) before
+    # computing the outputs from a half-updated state
+    merge_pool.shutdown(wait=True)
+    if pending_merge is not None:
+        pending_merge.result()
     print("Streaming engine stopped")
 
     # ----------------------------------------
     #       OUTPUTS COMPUTATION & PRINTS
     # ----------------------------------------
-    # Compute the approximate estimates obtained through count sketch
-    for u in histogram:
-        approx_freq_list = []
-        for j in np.arange(0,D):
-            approx_freq_list.append(g_hash(u,a[j+D],b[j+D]) * sketch[j,h_hash(u,a[j],b[j])])
-        approx_histogram[u] = np.median(approx_freq_list)
-
-    # Initialise useful structures for outputs computation
-    desc_histogram = sorted(histogram.items(), key = lambda item: item[1], reverse = True)
-    avg_error_list = []
-    F2_list = [[],[]]
+    # Compute the approximate estimates obtained through count sketch, for all the
+    # distinct items at once: the j-th row of "H" and "G" contains hj(u) and gj(u)
+    keys = np.fromiter(histogram.keys(), dtype=np.int64, count=len(histogram))
+    H = h_hash(keys.view(np.uint64), seeds[:D,None])
+    G = g_hash(keys.view(np.uint64), seeds[D:,None])
+    estimates = G * sketch[np.arange(D)[:,None], H]
+    # Median of the D estimates of each item: partially sort the columns just enough
+    # to place the middle element(s), instead of fully sorting them
+    if D % 2 == 1:
+        est = np.partition(estimates, D//2, axis=0)[D//2].astype(np.float64)
+    else:
+        middle = np.partition(estimates, [D//2-1, D//2], axis=0)
+        est = (middle[D//2-1] + middle[D//2]) / 2
+
+    # Compute the true and approximated second moment F2 over all the distinct items,
+    # normalized by the squared number of filtered items
+    freqs = np.fromiter(histogram.values(), dtype=np.int64, count=len(histogram))
+    F2_true = (freqs.astype(np.float64)**2).sum() / streamLength[1]**2
+    F2_est = (est**2).sum() / streamLength[1]**2
+
+    # Select the top-K items by true frequency, including all the items tied with the
+    # K-th highest frequency: a partial selection (O(N)) finds the K-th highest
+    # frequency, and only the selected items are sorted in descending order
+    # (no item is selected if K = 0 or if no item fell in [left, right])
+    K_top = min(K, len(freqs))
+    if K_top > 0:
+        kth_freq = np.partition(freqs, len(freqs)-K_top)[len(freqs)-K_top]
+        top = np.flatnonzero(freqs >= kth_freq)
+        top = top[np.argsort(-freqs[top], kind='stable')]
+    else:
+        top = np.array([], dtype=np.int64)
 
     # Print total n of items, total n of items in R, number of distinct items in R
     print("****** OUTPUT ******")
@@ -239,62 +336,14 @@ if __name__ == '__main__':
     print(f"Total number of items in [{left},{right}] = {streamLength[1]}")
     print(f"Number of distinct items in [{left},{right}] = {len(histogram)}")
 
-    # If K<=20: print the top K frequencies in descending order,
-    #           print the avg relative error of the top-K highest true frequencies
-    #           print F2
-    count = 1
+    # If K<=20: print the top K frequencies in descending order (and the items with
+    #           the same frequency as the K-th one)
     if K<=20:
-        # For loop to print the top K freq, and to store values to compute the avg error and F2
-        for k in np.arange(0,K):
-            item = desc_histogram[k][0]
-            true_freq = desc_histogram[k][1]
-            approx_freq = approx_histogram[desc_histogram[k][0]]
+        for item, true_freq, approx_freq in zip(keys[top].tolist(), freqs[top].tolist(), est[top].tolist()):
             print(f"Item {item} Freq = {true_freq} Est. Freq = {approx_freq}")
-            avg_error_list.append(abs(true_freq-approx_freq)/true_freq)          
-            F2_list[0].append(true_freq**2)
-            F2_list[1].append(approx_freq**2)
-        # Ensure to print all the items even if K, K+1, ... have all the same frequencies
-        while True:
-                if approx_histogram[desc_histogram[K-1][0]] == approx_histogram[desc_histogram[K-1+count][0]]:
-                    count += 1
-                    item = desc_histogram[K+count][0]
-                    true_freq = desc_histogram[K+count][1]
-                    approx_freq = approx_histogram[desc_histogram[K+count][0]]
-                    print(f"Item {item} Freq = {true_freq} Est. Freq = {approx_freq}")
-                    avg_error_list.append(abs(true_freq-approx_freq)/true_freq)
-                else:
-                    break
-        # For loop to store the remaining values to compute F2
-        for k in np.arange(K, len(histogram)):
-            F2_list[0].append(true_freq**2)
-            F2_list[1].append(approx_freq**2)
-        # Compute and print the avg error and F2
-        print(f"Avg err for top {K} = {np.mean(avg_error_list)}")
-        print(f"F2 {sum(F2_list[0])/(streamLength[1]**2)} F2 Estimate {sum(F2_list[1])/(streamLength[1]**2)}")
-
-    # If K> 20: print the avg relative error of the top-K highest true frequencies
-    #           print F2
-    else:
-        # For loop to store values to compute the avg error and F2
-        for k in np.arange(0,K):
-            true_freq = desc_histogram[k][1]
-            approx_freq = approx_histogram[desc_histogram[k][0]]
-            avg_error_list.append(abs(true_freq-approx_freq)/true_freq)
-            F2_list[0].append(true_freq**2)
-            F2_list[1].append(approx_freq**2)
-        # Ensure to compute the average error considering K, K+1, ... if they have the same frequency
-        while True:
-                if approx_histogram[desc_histogram[K-1][0]] == approx_histogram[desc_histogram[K-1+count][0]]:
-                    count += 1
-                    true_freq = desc_histogram[K+count][1]
-                    approx_freq = approx_histogram[desc_histogram[K+count][0]]
-                    avg_error_list.append(abs(true_freq-approx_freq)/true_freq)
-                else:
-                    break
-        # For loop to store the remaining values to compute F2
-        for k in np.arange(K,len(histogram)):
-            F2_list[0].append(true_freq**2)
-            F2_list[1].append(approx_freq**2)
-        # Compute and print the avg error and F2
-        print(f"Avg err for top {K} = {np.mean(avg_error_list)}")
-        print(f"F2 {sum(F2_list[0])/(streamLength[1]**2)} F2 Estimate {sum(F2_list[1])/(streamLength[1]**2)}")
\ No newline at end of file
+
+    # Print the avg relative error of the top-K highest true frequencies and F2
+    if top.size > 0:
+        avg_error = np.mean(np.abs(freqs[top] - est[top]) / freqs[top])
+        print(f"Avg err for top {K} = {avg_error}")
+    print(f"F2 {F2_true} F2 Estimate {F2_est}")
\ No newline at end of file